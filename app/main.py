@@ -1,5 +1,7 @@
 import argparse
 import asyncio
+import logging
+import sys
 
 from redis.database import Database
 
@@ -10,7 +12,13 @@ async def main():
     parser.add_argument('--dbfilename', help='The name of the RDB file')
     parser.add_argument('--port', help='The ustom port to start the Redis server')
     parser.add_argument('--replicaof', help='Replication settings')
+    parser.add_argument('--debug', action='store_true', help='Log every command')
     args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format='%(message)s',
+        stream=sys.stdout,
+    )
     db = Database.create(args)
     await db.serve()
 
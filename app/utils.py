@@ -1,21 +1,34 @@
+import logging
 import secrets
 import string
+from itertools import islice
 from typing import Any, Iterable, Optional, Tuple
 
+logger = logging.getLogger('redis')
 
-def print_action(role: str, action: str, message: Optional[str | bytes] = None):
+
+def log_action(
+    role: str,
+    action: str,
+    message: Optional[str | bytes | list] = None,
+    level: int = logging.DEBUG,
+):
+    # checked first, so the formatting below never runs unless it is logged
+    if not logger.isEnabledFor(level):
+        return
     try:
-        print(
-            role + ':',
-            action,
+        text = (
             message
             if type(message) is str
             else message.replace(b'\r\n', b' ').decode()
             if type(message) is bytes
-            else '',
+            else ' '.join(map(str, message))
+            if type(message) is list
+            else ''
         )
-    except (UnicodeDecodeError, TypeError):
-        print(role + ':', action, message)
+    except UnicodeDecodeError:
+        text = repr(message)
+    logger.log(level, '%s: %s %s', role, action, text)
 
 
 def random_string(length) -> str:
@@ -25,11 +38,11 @@ def random_string(length) -> str:
 
 
 def inc_id(id: str) -> str:
-    ts, seq = id.split('-')
-    return f'{ts}-{int(seq) + 1}'
+    ts, _, seq = id.partition('-')
+    return f'{ts}-{int(seq or 0) + 1}'
 
 
 def to_pairs(array: list) -> Iterable[Tuple[Any, Any]]:
+    # XREAD lists all keys first, then all ids: `key1 key2 id1 id2`
     half = len(array) // 2
-    keys, values = array[:half], array[half:]
-    return zip(keys, values)
+    return zip(islice(array, half), islice(array, half, None))
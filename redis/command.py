@@ -2,69 +2,73 @@ import asyncio
 import base64
 import contextlib
 import sys
-import time
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Any, List, Optional
+from typing import Any, ClassVar, Dict, List, Optional, Type
 
 import redis.resp as resp
-from app.utils import inc_id, print_action, to_pairs
-from redis.models import ReplicaConnection, WaitTrigger
-from redis.stream import StreamTrigger
+from app.utils import inc_id, log_action, to_pairs
+from redis.models import ReplicaConnection
+from redis.stream import INVALID_ID, StreamTrigger, is_valid_id
+
+RDB_BASE64 = 'UkVESVMwMDEx+glyZWRpcy12ZXIFNy4yLjD6CnJlZGlzLWJpdHPAQPoFY3RpbWXCbQi8ZfoIdXNlZC1tZW3CsMQQAPoIYW9mLWJhc2XAAP/wbjv+wP9aog=='
+RDB_BYTES = base64.b64decode(RDB_BASE64)
+RDB_HEADER = b'$%d\r\n' % len(RDB_BYTES)
+
+PONG = resp.simple_string('PONG')
+OK = resp.simple_string('OK')
+NULL_BULK_STRING = resp.bulk_string(None)
+GETACK = resp.array_flat(['REPLCONF', 'GETACK', '*'])
+PROTOCOL_ERROR = resp.simple_error('Protocol error')
+NOT_AN_INTEGER = resp.simple_error('value is not an integer or out of range')
+INVALID_TIMEOUT = resp.simple_error('timeout is not an integer or out of range')
 
 
 @dataclass
 class Command(ABC):
+    # as in Redis: n means exactly n words, -n at least n, counting the name
+    arity: ClassVar[int] = -1
     array: List[str]
     db: Any
     connection: ReplicaConnection
+    raw_len: int = 0
 
     @staticmethod
-    def parse(array: List[str], db, connection: ReplicaConnection) -> 'Command':
-        name = array[0].upper()
-        arguments = tuple(array[1:])
-        print_action(
-            db.role,
-            f'Received {name}',
-            ''
-            if len(arguments) == 0
-            else arguments[0]
-            if len(arguments) == 1
-            else ' '.join(arguments),
-        )
-        # fmt: off
-        match name:
-            case 'PING'     : return CommandPing(array, db, connection)
-            case 'ECHO'     : return CommandEcho(array, db, connection)
-            case 'SET'      : return CommandSet(array, db, connection)
-            case 'GET'      : return CommandGet(array, db, connection)
-            case 'CONFIG'   : return CommandConfig(array, db, connection)
-            case 'KEYS'     : return CommandKeys(array, db, connection)
-            case 'INFO'     : return CommandInfo(array, db, connection)
-            case 'REPLCONF' : return CommandReplConf(array, db, connection)
-            case 'PSYNC'    : return CommandPSync(array, db, connection)
-            case 'WAIT'     : return CommandWait(array, db, connection)
-            case 'TYPE'     : return CommandType(array, db, connection)
-            case 'XADD'     : return CommandXAdd(array, db, connection)
-            case 'XRANGE'   : return CommandXRange(array, db, connection)
-            case 'XREAD'    : return CommandXRread(array, db, connection)
-            case _          : return CommandUnknown(array, db, connection)
-        # fmt: on
+    def parse(
+        array: List[str], db, connection: ReplicaConnection, raw_len: int = 0
+    ) -> 'Command':
+        name = array[0]
+        cls = COMMANDS.get(name) or COMMANDS.get(name.upper(), CommandUnknown)
+        if not cls._accepts(len(array)):
+            cls = CommandWrongArity
+        log_action(db.role, 'Received', array)
+        return cls(array, db, connection, raw_len)
 
     async def execute(self):
         response = await self._respond()
 
-        if self.db.role == 'slave':
-            offset = len(self._pack())
-            self.db.inc_offset(offset)
+        if self.db.role == 'slave' and self.connection is self.db.master:
+            self.db.inc_offset(self.raw_len)
 
         if response:
-            print_action(self.db.role, 'Sending', response)
-            self.connection.writer.write(response)
-            await self.connection.writer.drain()
+            log_action(self.db.role, 'Sending', response)
+            self.connection.write(response)
+
+    def error_reply(self, e: Exception) -> bytes:
+        match e:
+            case IndexError():  # a subcommand missing its arguments
+                return resp.error_wrong_arity(self.array[0])
+            case ValueError():  # int() on a malformed argument
+                return NOT_AN_INTEGER
+            case _:
+                return resp.simple_error(f"failed to run '{self.array[0].lower()}'")
+
+    @classmethod
+    def _accepts(cls, n: int) -> bool:
+        return n == cls.arity if cls.arity > 0 else n >= -cls.arity
 
     def _pack(self) -> bytes:
-        return resp.array(self.array)
+        return resp.array_flat(self.array)
 
     @abstractmethod
     async def _respond(self) -> bytes | None: ...
@@ -75,19 +79,35 @@ class CommandUnknown(Command):
         return resp.error_unknown_command(self.array)
 
 
+class CommandWrongArity(Command):
+    async def _respond(self) -> bytes:
+        return resp.error_wrong_arity(self.array[0])
+
+
+class CommandProtocolError(Command):
+    async def _respond(self) -> bytes:
+        return PROTOCOL_ERROR
+
+
 class CommandPing(Command):
+    arity = -1
+
     async def _respond(self) -> Optional[bytes]:
         if self.db.role == 'master':
-            return resp.simple_string('PONG')
+            return PONG
         return None
 
 
 class CommandEcho(Command):
+    arity = 2
+
     async def _respond(self) -> bytes:
         return resp.bulk_string(self.array[1])
 
 
 class CommandSet(Command):
+    arity = -3
+
     async def _respond(self) -> Optional[bytes]:
         key, value = self.array[1:3]
         px = (
@@ -95,87 +115,96 @@ class CommandSet(Command):
             if (len(self.array) == 5 and self.array[3].upper() == 'PX')
             else None
         )
-        expiry = px and (time.time() * 1000 + px)
+        expiry = px and (self.db.now() + px)
 
         self.db.set(key, value, expiry)
         if self.db.role == 'master':
-            propagate_command = self.db.propagate_command(self._pack())
-            asyncio.create_task(propagate_command)
-            return resp.simple_string('OK')
+            self.db.propagate_command(self._pack())
+            return OK
         return None
 
 
 class CommandGet(Command):
+    arity = 2
+
     async def _respond(self) -> bytes:
         value = self.db.get(self.array[1])
-        return resp.bulk_string(value)
+        return NULL_BULK_STRING if value is None else resp.bulk_string(value)
 
 
 class CommandConfig(Command):
+    arity = -3
+
     async def _respond(self) -> bytes:
         subcommand = self.array[1].upper()
         match subcommand:
             case 'GET':
                 key = self.array[2]
                 value = self.db.config.get(key)
-                return resp.array([key, value])
+                return resp.array_flat([key, value])
             case _:
                 return resp.error_unknown_command(self.array)
 
 
 class CommandKeys(Command):
+    arity = 2
+
     async def _respond(self) -> bytes:
-        keys = self.db.store.keys()
-        return resp.array(keys)
+        return resp.array_flat(self.db.keys())
 
 
 class CommandInfo(Command):
+    arity = -1
+
     async def _respond(self) -> bytes:
-        info = '# Replication\n'
-        info += f'role:{self.db.role}\n'
+        info = self.db.info
         if self.db.role == 'master':
-            info += f'master_replid:{self.db.master_replid}\n'
-            info += f'master_repl_offset:{self.db.master_repl_offset}\n'
+            info += f'{self.db.master_repl_offset}\n'
         return resp.bulk_string(info)
 
 
 class CommandReplConf(Command):
+    arity = -2
+
     async def _respond(self) -> Optional[bytes]:
         subcommand = self.array[1].upper()
         match subcommand:
-            case 'LISTENING-PORT':
-                return resp.simple_string('OK')
-            case 'CAPA':
-                return resp.simple_string('OK')
+            case 'LISTENING-PORT' | 'CAPA':
+                return OK
             case 'GETACK':
                 if self.db.role == 'slave':
-                    return resp.array(['REPLCONF', 'ACK', self.db.slave_repl_offset])
+                    ack = ['REPLCONF', 'ACK', self.db.slave_repl_offset]
+                    return resp.array_flat(ack)
             case 'ACK':
                 if self.db.role == 'master':
                     offset = int(self.array[2])
-                    self.db.update_replica_offset(self.connection, offset)
+                    await self.db.update_replica_offset(self.connection, offset)
             case _:
                 return resp.error_unknown_command(self.array)
         return None
 
 
 class CommandPSync(Command):
+    arity = 3
+
     async def _respond(self) -> bytes:
         if self.db.role == 'master':
             self.db.register_replica(self.connection)
 
-        RDB_BASE64 = 'UkVESVMwMDEx+glyZWRpcy12ZXIFNy4yLjD6CnJlZGlzLWJpdHPAQPoFY3RpbWXCbQi8ZfoIdXNlZC1tZW3CsMQQAPoIYW9mLWJhc2XAAP/wbjv+wP9aog=='
-        RDB_BYTES = base64.b64decode(RDB_BASE64)
-        return (
-            resp.simple_string(
-                f'FULLRESYNC {self.db.master_replid} {self.db.master_repl_offset}'
-            )
-            + f'${len(RDB_BYTES)}\r\n'.encode()
-            + RDB_BYTES
+        return b''.join(
+            [
+                resp.simple_string(
+                    f'FULLRESYNC {self.db.master_replid} {self.db.master_repl_offset}'
+                ),
+                RDB_HEADER,
+                RDB_BYTES,
+            ]
         )
 
 
 class CommandWait(Command):
+    arity = 3
+
     async def _respond(self) -> Optional[bytes]:
         if self.db.role == 'master':
             num_replicas, timeout = map(int, self.array[1:])
@@ -185,24 +214,27 @@ class CommandWait(Command):
             if ack_replicas >= num_replicas:
                 return resp.integer(ack_replicas)
 
-            trigger = WaitTrigger(num_replicas, master_offset)
-            self.db.wait_triggers.append(trigger)
-            get_ack = resp.array('REPLCONF GETACK *'.split())
+            def enough_acks():
+                acks = self.db.replication_count_acks_by_offset(master_offset)
+                return acks >= num_replicas
 
             if master_offset > 0:
-                await self.db.propagate_command(get_ack)
+                self.db.propagate_command(GETACK)
+                condition = self.db.ack_condition
                 with contextlib.suppress(asyncio.TimeoutError):
-                    await asyncio.wait_for(trigger.event.wait(), timeout / 1000)
+                    async with condition:
+                        wait = condition.wait_for(enough_acks)
+                        await asyncio.wait_for(wait, timeout / 1000)
 
-            ack_replicas = self.db.replication_count_acks_by_offset(
-                trigger.master_offset
-            )
+            ack_replicas = self.db.replication_count_acks_by_offset(master_offset)
             return resp.integer(ack_replicas)
 
         return None
 
 
 class CommandType(Command):
+    arity = 2
+
     async def _respond(self) -> bytes:
         key = self.array[1]
         if self.db.get(key) is not None:
@@ -214,48 +246,91 @@ class CommandType(Command):
 
 
 class CommandXAdd(Command):
+    arity = -5
+
     async def _respond(self) -> bytes:
         key, id = self.array[1:3]
         entry = [id, self.array[3:]]
-        self.db.check_stream_triggers(key, id)
-        return self.db.stream.add(key, entry)
+        response = self.db.stream.add(key, entry)
+        if not response.startswith(b'-'):
+            # entry[0] now holds the id XADD actually assigned
+            self.db.check_stream_triggers(key, entry[0])
+        return response
 
 
 class CommandXRange(Command):
+    arity = 4
+
     async def _respond(self) -> bytes:
         key, start, end = self.array[1:]
-        entries = self.db.stream.range(key, start, end)
+        try:
+            entries = self.db.stream.range(key, start, end)
+        except ValueError:
+            return INVALID_ID
         return resp.array(entries)
 
 
 class CommandXRread(Command):
+    arity = -4
+
     def _read(self, request) -> bytes:
         result = [
             [key, self.db.stream.range(key, inc_id(start), '+')]
             for key, start in to_pairs(request)
         ]
         is_empty = all(not len(stream[1]) for stream in result)
-        return resp.bulk_string(None) if is_empty else resp.array(result)
+        return NULL_BULK_STRING if is_empty else resp.array(result)
+
+    def _has_valid_ids(self, request) -> bool:
+        return all(is_valid_id(id) for _, id in to_pairs(request))
 
     def _replace_dollars(self):
+        ids_start = 4 + (len(self.array) - 4) // 2
         for i, (key, id) in enumerate(to_pairs(self.array[4:])):
             if id == '$':
                 entries = self.db.stream.read(key)
-                self.array[4 + 2 * i + 1] = (
-                    '0-0' if not len(entries) else entries[-1][0]
-                )
+                self.array[ids_start + i] = entries[-1][0] if entries else '0-0'
 
     async def _respond(self) -> Optional[bytes]:
         subcommand = self.array[1].upper()
         match subcommand:
             case 'STREAMS':
+                if not self._has_valid_ids(self.array[2:]):
+                    return INVALID_ID
                 return self._read(self.array[2:])
             case 'BLOCK':
+                if not self.array[2].isdigit():
+                    return INVALID_TIMEOUT
+                timeout = (int(self.array[2]) / 1000) or sys.maxsize
                 self._replace_dollars()
+                if not self._has_valid_ids(self.array[4:]):
+                    return INVALID_ID
                 trigger = StreamTrigger(self.array[4:])
-                self.db.stream_triggers.append(trigger)
-                timeout = (int(self.array[2]) / 1000) or sys.maxsize
-                with contextlib.suppress(asyncio.TimeoutError):
-                    await asyncio.wait_for(trigger.event.wait(), timeout)
+                self.db.add_stream_trigger(trigger)
+                try:
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(trigger.event.wait(), timeout)
+                finally:
+                    self.db.remove_stream_trigger(trigger)
                 return self._read(self.array[4:])
         return None
+
+
+# fmt: off
+COMMANDS: Dict[str, Type[Command]] = {
+    'PING'     : CommandPing,
+    'ECHO'     : CommandEcho,
+    'SET'      : CommandSet,
+    'GET'      : CommandGet,
+    'CONFIG'   : CommandConfig,
+    'KEYS'     : CommandKeys,
+    'INFO'     : CommandInfo,
+    'REPLCONF' : CommandReplConf,
+    'PSYNC'    : CommandPSync,
+    'WAIT'     : CommandWait,
+    'TYPE'     : CommandType,
+    'XADD'     : CommandXAdd,
+    'XRANGE'   : CommandXRange,
+    'XREAD'    : CommandXRread,
+}
+# fmt: on
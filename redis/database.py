@@ -1,17 +1,22 @@
 import asyncio
+import heapq
+import logging
 import os
 import time
 from argparse import Namespace
-from asyncio.streams import StreamReader, StreamWriter
-from typing import Dict, List, Optional
+from bisect import bisect_left, insort
+from collections import defaultdict
+from typing import DefaultDict, Dict, List, Optional, Tuple
 
-import redis.resp as resp
-from app.utils import print_action, random_string
+from app.utils import log_action, random_string
 from redis.models import ReplicaConnection
 from redis.persistence import Persistence
-from redis.stream import Stream, StreamTrigger
+from redis.protocol import RespProtocol
+from redis.stream import Stream, StreamTrigger, parse_id
 
 DEFAULT_PORT = 6379
+# as Redis' replica output-buffer limit: drop replicas this far behind
+REPLICA_BUFFER_LIMIT = 256 * 1024 * 1024
 
 
 class Database:
@@ -21,6 +26,10 @@ class Database:
 
     def __init__(self, args: Namespace):
         self.store: Dict[str, tuple[str, Optional[float]]] = {}
+        self.expiry_heap: List[tuple[float, str]] = []
+        # monotonic clock anchored to wall-clock ms, as expiries are absolute
+        self.clock_offset = time.time() * 1000 - time.monotonic() * 1000
+        self.cached_now: Optional[float] = None
         self.stream = Stream()
         self.config = vars(args)
         self.port = args.port or DEFAULT_PORT
@@ -30,32 +39,52 @@ class Database:
             self.persistence = Persistence(self)
 
     async def serve(self):
-        server = await asyncio.start_server(
-            self._handle_connection, 'localhost', self.port
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            lambda: RespProtocol(self), 'localhost', self.port
         )
-        print_action(self.role, f'Listening on port {self.port}.')
+        log_action(self.role, f'Listening on port {self.port}.', level=logging.INFO)
+        asyncio.create_task(self._expire_loop())
         async with server:
             await server.serve_forever()
 
-    async def _handle_connection(
-        self, reader: StreamReader, writer: StreamWriter, bufsize=1024
-    ):
-        while buffer := await reader.read(bufsize):
-            await self._handle_incoming(buffer, ReplicaConnection(reader, writer))
-        writer.close()
-
-    async def _handle_incoming(self, buffer, connection: ReplicaConnection):
-        for command in resp.parse(buffer, self, connection):
-            await command.execute()
+    def now(self) -> float:
+        # read once per event-loop iteration, like Redis caching mstime
+        if self.cached_now is None:
+            self.cached_now = time.monotonic() * 1000 + self.clock_offset
+            asyncio.get_running_loop().call_soon(self._clear_now)
+        return self.cached_now
+
+    def _clear_now(self):
+        self.cached_now = None
+
+    async def _expire_loop(self, interval=0.1):
+        while True:
+            await asyncio.sleep(interval)
+            self._evict_expired()
+
+    def _evict_expired(self):
+        now = self.now()
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expiry, key = heapq.heappop(self.expiry_heap)
+            # skip keys that were overwritten since this expiry was pushed
+            if (item := self.store.get(key)) and item[1] == expiry:
+                del self.store[key]
 
     def set(self, key: str, value: str, expiry: Optional[float] = None):
         self.store[key] = (value, expiry)
+        if expiry:
+            heapq.heappush(self.expiry_heap, (expiry, key))
+
+    def keys(self) -> List[str]:
+        self._evict_expired()
+        return list(self.store)
 
     def get(self, key: str) -> Optional[str]:
         value = None
         if item := self.store.get(key):
             value, expiry = item
-            if expiry and time.time() * 1000 >= expiry:
+            if expiry and self.now() >= expiry:
                 value = None
                 del self.store[key]
         return value
@@ -65,52 +94,107 @@ class DatabaseMaster(Database):
     def __init__(self, args: Namespace):
         super().__init__(args)
         self.role = 'master'
-        self.replicas: List[ReplicaConnection] = []
+        self.replicas: Dict[int, ReplicaConnection] = {}
+        self.replica_offsets: List[int] = []  # sorted
+        self.flush_scheduled = False
         self.master_replid = random_string(40)
         self.master_repl_offset = 0
-        self.wait_triggers: List[StreamTrigger] = []
-        self.stream_triggers: List[StreamTrigger] = []
+        self.info = (
+            '# Replication\n'
+            'role:master\n'
+            f'master_replid:{self.master_replid}\n'
+            'master_repl_offset:'
+        )
+        self.ack_condition = asyncio.Condition()
+        self.stream_triggers: DefaultDict[
+            str, List[Tuple[Tuple[int, int], StreamTrigger]]
+        ] = defaultdict(list)
 
     def register_replica(self, replica: ReplicaConnection):
-        self.replicas.append(replica)
-        print_action(self.role, f'Added replica from {replica.port}')
-
-    def update_replica_offset(self, connection, offset):
-        self.wait_triggers = [
-            trigger for trigger in self.wait_triggers if not trigger.event.is_set()
+        self.replicas[replica.port] = replica
+        insort(self.replica_offsets, replica.replication_offset)
+        log_action(self.role, f'Added replica from {replica.port}', level=logging.INFO)
+
+    def drop_replica(self, replica: ReplicaConnection):
+        del self.replicas[replica.port]
+        del self.replica_offsets[
+            bisect_left(self.replica_offsets, replica.replication_offset)
         ]
-
-        for replica in self.replicas:
-            if connection.port == replica.port:
-                replica.update_offset(offset)
-
-        for trigger in self.wait_triggers:
-            if (
-                self.replication_count_acks_by_offset(trigger.master_offset)
-                >= trigger.num_replicas
-            ):
-                trigger.event.set()
-
-    async def propagate_command(self, command: bytes):
+        replica.transport.abort()  # close() would wait for the backlog to drain
+        action = f'Dropped replica {replica.port}, output buffer over limit'
+        log_action(self.role, action, level=logging.WARNING)
+
+    async def update_replica_offset(self, connection, offset):
+        replica = self.replicas.get(connection.port)
+        if replica is None:
+            return
+        old = bisect_left(self.replica_offsets, replica.replication_offset)
+        del self.replica_offsets[old]
+        insort(self.replica_offsets, offset)
+        replica.update_offset(offset)
+
+        async with self.ack_condition:
+            self.ack_condition.notify_all()
+
+    def propagate_command(self, command: bytes):
         self.master_repl_offset += len(command)
-        for replica in self.replicas:
-            print_action(self.role, f'Propagating to {replica.port}:', command)
-            replica.writer.write(command)
-            await replica.writer.drain()
+        log_action(self.role, 'Propagating', command)
+        for replica in self.replicas.values():
+            replica.outbox += command
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush_replicas)
+
+    def _flush_replicas(self):
+        self.flush_scheduled = False
+        lagging = []
+        for replica in self.replicas.values():
+            if replica.outbox:
+                replica.write(bytes(replica.outbox))
+                replica.outbox.clear()
+                if replica.transport.get_write_buffer_size() > REPLICA_BUFFER_LIMIT:
+                    lagging.append(replica)
+        for replica in lagging:
+            self.drop_replica(replica)
+
+    def add_stream_trigger(self, trigger: StreamTrigger):
+        for key, id in trigger.conditions:
+            self.stream_triggers[key].append((parse_id(id), trigger))
+
+    def remove_stream_trigger(self, trigger: StreamTrigger):
+        for key, _ in trigger.conditions:
+            if key not in self.stream_triggers:
+                continue  # already pruned by check_stream_triggers
+            waiting = [
+                (min_id, other)
+                for min_id, other in self.stream_triggers[key]
+                if other is not trigger
+            ]
+            if waiting:
+                self.stream_triggers[key] = waiting
+            else:
+                del self.stream_triggers[key]
 
     def check_stream_triggers(self, key: str, id: str):
-        self.stream_triggers = [
-            trigger for trigger in self.stream_triggers if not trigger.event.is_set()
-        ]
-        for trigger in self.stream_triggers:
-            if any(
-                key == condition[0] and id > condition[1]
-                for condition in trigger.conditions
-            ):
+        if key not in self.stream_triggers:
+            return
+        new_id = parse_id(id)
+        waiting = []
+        for min_id, trigger in self.stream_triggers[key]:
+            if trigger.event.is_set():
+                continue  # fired through another key
+            if new_id > min_id:
                 trigger.event.set()
+            else:
+                waiting.append((min_id, trigger))
+        if waiting:
+            self.stream_triggers[key] = waiting
+        else:
+            del self.stream_triggers[key]
 
     def replication_count_acks_by_offset(self, master_offset):
-        return sum(r.replication_offset >= master_offset for r in self.replicas)
+        offsets = self.replica_offsets
+        return len(offsets) - bisect_left(offsets, master_offset)
 
 
 class DatabaseReplica(Database):
@@ -120,33 +204,24 @@ class DatabaseReplica(Database):
         master_host, master_port = args.replicaof.split()
         self.replicaof = (master_host, int(master_port))
         self.master: ReplicaConnection
+        self.uplink: RespProtocol
         self.slave_repl_offset = 0
+        self.info = '# Replication\nrole:slave\n'
 
     async def serve(self):
         await self._handshake()
-        handle_master = super()._handle_connection(
-            self.master.reader, self.master.writer
-        )
-        asyncio.create_task(handle_master)
         await super().serve()
 
     def inc_offset(self, n: int):
         self.slave_repl_offset += n
 
     async def _handshake(self):
-        self.master = ReplicaConnection(*await asyncio.open_connection(*self.replicaof))
-        await self._send_command('ping')
-        await self._send_command('REPLCONF', 'listening-port', self.port)
-        await self._send_command('REPLCONF', 'capa', 'psync2')
-        await self._send_command('PSYNC', '?', '-1')
-
-    async def _send_command(self, *strings: str) -> bytes:
-        command = resp.array(strings)
-        print_action(self.role, 'Sending', command)
-        self.master.writer.write(command)
-        await self.master.writer.drain()
-        return await self._recv_response()
-
-    async def _recv_response(self, bufsize=1024):
-        buffer = await self.master.reader.read(bufsize)
-        await super()._handle_incoming(buffer, self.master)
+        loop = asyncio.get_running_loop()
+        _, self.uplink = await loop.create_connection(
+            lambda: RespProtocol(self, is_replica_uplink=True), *self.replicaof
+        )
+        self.master = self.uplink.connection
+        await self.uplink.send_command('ping')
+        await self.uplink.send_command('REPLCONF', 'listening-port', self.port)
+        await self.uplink.send_command('REPLCONF', 'capa', 'psync2')
+        await self.uplink.send_command('PSYNC', '?', '-1')
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Optional
+
+import redis.resp as resp
+from app.utils import log_action, logger
+from redis.command import Command, CommandProtocolError
+from redis.models import ReplicaConnection
+
+try:
+    import hiredis
+except ImportError:
+    hiredis = None
+
+COMPACT_THRESHOLD = 64 * 1024
+WRITE_BUFFER_HIGH = 1024 * 1024
+
+
+class RespProtocol(asyncio.Protocol):
+    def __init__(self, db, is_replica_uplink=False):
+        self.db = db
+        # the uplink needs exact frame lengths for the replication offset, and
+        # carries the RDB file, which is not valid RESP
+        self.is_replica_uplink = is_replica_uplink
+        use_hiredis = hiredis and not is_replica_uplink
+        self.reader = hiredis.Reader(encoding='utf-8') if use_hiredis else None
+        self.responses: Deque[asyncio.Future] = deque()
+        self.buf = bytearray()
+        self.pos = 0
+        self.connection: ReplicaConnection
+        self.commands: asyncio.Queue[Optional[Command]] = asyncio.Queue()
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def connection_made(self, transport):
+        transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        self.connection = ReplicaConnection(transport)
+        port = self.connection.port
+        if self.is_replica_uplink:
+            log_action(self.db.role, f'Connected to master {port}', level=logging.INFO)
+        else:
+            log_action(self.db.role, f'Accepted client {port}', level=logging.INFO)
+        self.worker = asyncio.create_task(self._execute_commands())
+
+    def connection_lost(self, exc):
+        self.writable.set()
+        self.commands.put_nowait(None)
+
+    def eof_received(self):
+        # keep the transport open until the queued commands have replied
+        self.commands.put_nowait(None)
+        return True
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def data_received(self, data: bytes):
+        if self.reader:
+            self._drain_replies(data)
+        else:
+            self.buf += data
+            self._drain_commands()
+
+    def _drain_replies(self, data: bytes):
+        self.reader.feed(data)
+        try:
+            while (array := self.reader.gets()) is not False:
+                if not _is_command(array):
+                    raise resp.ProtocolError('expected an array of bulk strings')
+                command = Command.parse(array, self.db, self.connection)
+                self.commands.put_nowait(command)
+        except (hiredis.ProtocolError, ValueError) as e:
+            self._protocol_error(e)
+
+    def _drain_commands(self):
+        parse = resp.parse_reply if self.is_replica_uplink else resp.parse
+        try:
+            while self.pos < len(self.buf):
+                frame = parse(self.buf, self.pos)
+                if frame is None:
+                    break
+                value, end = frame
+                if type(value) is list:
+                    raw_len = end - self.pos
+                    command = Command.parse(value, self.db, self.connection, raw_len)
+                    self.commands.put_nowait(command)
+                else:
+                    self._on_reply(value)
+                self.pos = end
+        except ValueError as e:
+            self._protocol_error(e)
+            return
+
+        if self.pos == len(self.buf):
+            self.buf.clear()
+            self.pos = 0
+        elif self.pos > COMPACT_THRESHOLD:
+            del self.buf[: self.pos]
+            self.pos = 0
+
+    def _protocol_error(self, e: Exception):
+        action = f'Protocol error from {self.connection.port}:'
+        log_action(self.db.role, action, str(e), level=logging.WARNING)
+        # answer after the commands already queued, then hang up
+        self.connection.transport.pause_reading()
+        self.buf.clear()
+        self.pos = 0
+        if not self.is_replica_uplink:
+            error = CommandProtocolError([], self.db, self.connection)
+            self.commands.put_nowait(error)
+        self.commands.put_nowait(None)
+
+    def _on_reply(self, reply: str | bytes):
+        log_action(self.db.role, 'Received', reply)
+        if type(reply) is str and self.responses:
+            self.responses.popleft().set_result(reply)
+
+    def send_command(self, *strings) -> asyncio.Future:
+        response = asyncio.get_running_loop().create_future()
+        self.responses.append(response)
+        command = resp.array_flat(strings)
+        log_action(self.db.role, 'Sending', command)
+        self.connection.write(command)
+        return response
+
+    async def _execute_commands(self):
+        while command := await self.commands.get():
+            await self.writable.wait()
+            try:
+                await command.execute()
+            except Exception as e:
+                logger.exception('%s: Failed %s', self.db.role, command.array)
+                if not self.is_replica_uplink:
+                    self.connection.write(command.error_reply(e))
+        self.connection.transport.close()
+
+
+def _is_command(frame) -> bool:
+    return type(frame) is list and bool(frame) and all(type(s) is str for s in frame)
@@ -1,8 +1,10 @@
-from typing import Iterable, List, Optional, Tuple
+from typing import List, Optional, Tuple
 
-from app.utils import print_action
-from redis.command import Command
-from redis.models import ReplicaConnection
+ASTERISK = ord('*')
+DOLLAR = ord('$')
+PLUS = ord('+')
+ZERO = ord('0')
+NINE = ord('9')
 
 
 def integer(n: int) -> bytes:
@@ -21,61 +23,136 @@ def error_unknown_command(array: List[str]) -> bytes:
     return simple_error(f'Unknown command {" ".join(array)}')
 
 
+def error_wrong_arity(name: str) -> bytes:
+    return simple_error(f"wrong number of arguments for '{name.lower()}' command")
+
+
 def bulk_string(string: Optional[str]) -> bytes:
     if string is None:
-        return '$-1\r\n'.encode()
+        return b'$-1\r\n'
     else:
         string = str(string)
         return f'${len(string)}\r\n{string}\r\n'.encode()
 
 
+def array_flat(items) -> bytes:
+    parts = [b'*%d\r\n' % len(items)]
+    for item in items:
+        if item is None:
+            parts.append(b'$-1\r\n')
+        else:
+            encoded = str(item).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(encoded), encoded))
+    return b''.join(parts)
+
+
 def array(items) -> bytes:
-    return f'*{len(items)}\r\n'.encode() + b''.join(
-        array(item) if type(item) is list else bulk_string(item) for item in items
-    )
-
-
-def parse(buffer: bytes, db, connection: ReplicaConnection) -> Iterable[Command]:
-    while buffer:
-        # print_action(db.role, 'Parsing', buffer)
-        if buffer.startswith(b'*'):  # array
-            array, buffer = _read_array(buffer)
-            yield Command.parse(array, db, connection)
-        elif buffer.startswith(b'+'):  # simple string
-            bytes, buffer = _read_token(buffer)
-            print_action(db.role, 'Received', bytes)
-        elif b'REDIS' in buffer:
-            rdb, buffer = _read_rdb(buffer)
-            print_action(db.role, 'Received', rdb)
-
-
-def _read_array(buffer: bytes) -> Tuple[List[str], bytes]:
+    parts = [b'*%d\r\n' % len(items)]
+    stack = [iter(items)]
+    while stack:
+        for item in stack[-1]:
+            if type(item) is list:
+                parts.append(b'*%d\r\n' % len(item))
+                stack.append(iter(item))
+                break
+            if item is None:
+                parts.append(b'$-1\r\n')
+            else:
+                encoded = str(item).encode()
+                parts.append(b'$%d\r\n%s\r\n' % (len(encoded), encoded))
+        else:
+            stack.pop()
+    return b''.join(parts)
+
+
+class IncompleteFrame(Exception):
+    pass
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def parse(buffer: bytearray, pos: int) -> Optional[Tuple[List[str], int]]:
+    with memoryview(buffer) as mv:
+        try:
+            return _parse_array(mv, pos)
+        except IncompleteFrame:
+            return None
+
+
+def parse_reply(
+    buffer: bytearray, pos: int
+) -> Optional[Tuple[List[str] | str | bytes, int]]:
+    with memoryview(buffer) as mv:
+        try:
+            if mv[pos] == ASTERISK:
+                return _parse_array(mv, pos)
+            if mv[pos] == PLUS:
+                return _parse_simple_string(mv, pos)
+            _expect(mv, pos, DOLLAR)
+            return _parse_rdb(mv, pos)
+        except IncompleteFrame:
+            return None
+
+
+def _parse_array(mv: memoryview, pos: int) -> Tuple[List[str], int]:
+    _expect(mv, pos, ASTERISK)
+    length, pos = _parse_length(mv, pos + 1)
+    if length < 1:
+        raise ProtocolError('expected a non-empty array')
     array = []
-    raw_length, buffer = _read_token(buffer[1:])
-    length = int(raw_length.decode())
-    for i in range(length):
-        string, buffer = _read_bulk_string(buffer)
+    for _ in range(length):
+        string, pos = _parse_bulk_string(mv, pos)
         array.append(string)
-    return array, buffer
+    return array, pos
+
+
+def _parse_bulk_string(mv: memoryview, pos: int) -> Tuple[str, int]:
+    if pos >= len(mv):
+        raise IncompleteFrame
+    _expect(mv, pos, DOLLAR)
+    length, pos = _parse_length(mv, pos + 1)
+    if length < 0:
+        raise ProtocolError('invalid bulk length')
+    end = pos + length
+    if end + 2 > len(mv):
+        raise IncompleteFrame
+    # decode off the view: the recv buffer is compacted in place, so no view
+    # may outlive the parse
+    return str(mv[pos:end], 'utf-8'), end + 2
+
+
+def _parse_simple_string(mv: memoryview, pos: int) -> Tuple[str, int]:
+    sep = mv.obj.find(b'\r\n', pos)
+    if sep < 0:
+        raise IncompleteFrame
+    return str(mv[pos + 1 : sep], 'utf-8'), sep + 2
+
+
+def _parse_rdb(mv: memoryview, pos: int) -> Tuple[bytes, int]:
+    # sent right after FULLRESYNC: a bulk string without the trailing CRLF
+    length, pos = _parse_length(mv, pos + 1)
+    end = pos + length
+    if end > len(mv):
+        raise IncompleteFrame
+    return bytes(mv[pos:end]), end
 
 
-def _read_bulk_string(buffer) -> Tuple[str, bytes]:
-    raw_length, buffer = _read_token(buffer)
-    assert raw_length.startswith(b'$')
-    length = int(raw_length[1:].decode())
-    string = buffer[:length]
-    return string.decode(), buffer[length + 2 :]
+def _expect(mv: memoryview, pos: int, marker: int):
+    if mv[pos] != marker:
+        raise ProtocolError(f'expected {chr(marker)!r}, got {chr(mv[pos])!r}')
 
 
-def _read_token(buffer: bytes) -> Tuple[bytes, bytes]:
-    sep = buffer.index(b'\r\n')
-    token = buffer[:sep]
-    return token, buffer[sep + 2 :]
+def _parse_length(mv: memoryview, pos: int) -> Tuple[int, int]:
+    sep = mv.obj.find(b'\r\n', pos)
+    if sep < 0:
+        raise IncompleteFrame
+    return _parse_int(mv, pos, sep), sep + 2
 
 
-def _read_rdb(buffer: bytes) -> Tuple[bytes, bytes]:
-    raw_length, buffer = _read_token(buffer)
-    assert raw_length.startswith(b'$')
-    length = int(raw_length[1:].decode())
-    file = buffer[:length]
-    return file, buffer[length:]
+def _parse_int(mv: memoryview, start: int, end: int) -> int:
+    # most lengths are a single digit (`*3`, `$4`): skip int() for those
+    if end - start == 1 and ZERO <= mv[start] <= NINE:
+        return mv[start] - ZERO
+    return int(mv[start:end])
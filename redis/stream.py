@@ -1,12 +1,17 @@
 import asyncio
-import re
+import sys
 import time
-from collections import defaultdict
-from dataclasses import dataclass
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
 
 import redis.resp as resp
 from app.utils import to_pairs
 
+INVALID_ID = resp.simple_error(
+    'Invalid stream ID specified as stream command argument'
+)
+
 
 class StreamTrigger:
     def __init__(self, array):
@@ -14,52 +19,66 @@ class StreamTrigger:
         self.conditions = list(to_pairs(array))
 
 
+def is_valid_id(id: str) -> bool:
+    ts, _, seq = id.partition('-')
+    return ts.isdigit() and (not seq or seq.isdigit())
+
+
+def parse_id(id: str, default_seq: int = 0) -> Tuple[int, int]:
+    if not is_valid_id(id):
+        raise ValueError(f'Invalid stream ID {id!r}')
+    ts, _, seq = id.partition('-')
+    return int(ts), int(seq) if seq else default_seq
+
+
 @dataclass
 class Stream:
-    store = defaultdict(list)  # type: ignore
+    # per key: (ts, seq) ids for bisecting, and the [id, fields] entries
+    store: Dict[str, Tuple[List[Tuple[int, int]], List[list]]] = field(
+        default_factory=dict
+    )
 
     def add(self, key: str, entry) -> bytes:
         id = entry[0]
-        entries = self.store[key]
-        if id == '0-0':
-            return resp.simple_error(
-                'The ID specified in XADD must be greater than 0-0'
-            )
+        ids, entries = self.store.get(key, ([], []))
+        last_id = ids[-1] if ids else None
 
-        last_entry_id = entries[-1][0] if len(entries) else None
-        if last_entry_id:
-            last_ts, last_seq = last_entry_id.split('-')
-
-        if match := re.search(r'(\d*)-\*', id):
-            ts = match.group(1)
-            if not last_entry_id:
-                id = f'{ts}-{int(ts == "0")}'
+        if id.endswith('-*') and id[:-2].isdigit():
+            ts = int(id[:-2])
+            if not last_id:
+                new_id = (ts, int(ts == 0))
             else:
-                seq = 0 if ts > last_ts else int(last_seq) + 1
-                id = f'{ts}-{seq}'
+                new_id = (ts, 0 if ts > last_id[0] else last_id[1] + 1)
         elif id == '*':
-            if not last_entry_id:
-                ts = int(time.time() * 1000)
-                id = f'{ts}-0'
+            if not last_id:
+                new_id = (int(time.time() * 1000), 0)
             else:
-                id = f'{last_ts}-{int(last_seq) + 1}'
-        elif last_entry_id and id <= last_entry_id:
+                new_id = (last_id[0], last_id[1] + 1)
+        elif is_valid_id(id):
+            new_id = parse_id(id)
+        else:
+            return INVALID_ID
+
+        if new_id == (0, 0):
+            return resp.simple_error(
+                'The ID specified in XADD must be greater than 0-0'
+            )
+        if last_id and new_id <= last_id:
             return resp.simple_error(
                 'The ID specified in XADD is equal or smaller than the target stream top item'
             )
 
-        entry[0] = id
+        entry[0] = f'{new_id[0]}-{new_id[1]}'
+        ids.append(new_id)
         entries.append(entry)
-        return resp.bulk_string(id)
-
-    def read(self, key: str):
-        return self.store.get(key)
+        self.store[key] = (ids, entries)
+        return resp.bulk_string(entry[0])
 
-    def range(self, key: str, start: str, end: str) -> bytes:
-        def test(entry):
-            return (start == '-' or start <= entry[0]) and (
-                end == '+' or entry[0] <= end
-            )
+    def read(self, key: str) -> Optional[List[list]]:
+        return self.store[key][1] if key in self.store else None
 
-        entries = self.store.get(key)
-        return list(filter(test, entries))  # type: ignore
+    def range(self, key: str, start: str, end: str) -> List[list]:
+        ids, entries = self.store.get(key, ([], []))
+        lo = 0 if start == '-' else bisect_left(ids, parse_id(start))
+        hi = len(ids) if end == '+' else bisect_right(ids, parse_id(end, sys.maxsize))
+        return entries[lo:hi]